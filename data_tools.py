@@ -6,17 +6,118 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import h5py
-from scipy.optimize import curve_fit
+from scipy.optimize import curve_fit, least_squares
+from scipy.sparse import csr_matrix
 import lmfit
 from lmfit import Model, Parameters, minimize, fit_report
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None # fall back to numpy line shapes in the fits
+    
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    Parallel = None # fit data sets one at a time
+
 ###################
 ### HDF IMPORTS ###
 ###################
 
+HDF_CACHE_NBYTES = 64*1024**2 # minimum raw data chunk cache per file
+HDF_CACHE_NSLOTS = 1000003 # prime, as recommended for the chunk hash table
+HDF_CACHE_MAXFILES = 32 # number of open file handles kept by open_hdf5
+
+_hdf5_files = {} # open handles keyed by full path, least recently used first
+
+def _chunk_cache_nbytes(f):
+    """ chunk cache size that holds at least 8 chunks of every dataset in f """
+    nbytes = [HDF_CACHE_NBYTES]
+    def visit(name, obj):
+        if(isinstance(obj, h5py.Dataset) and obj.chunks):
+            nbytes.append(8*int(np.prod(obj.chunks))*obj.dtype.itemsize)
+    f.visititems(visit)
+    return max(nbytes)
+
+def _open_hdf5_file(fullpath):
+    f = h5py.File(fullpath, 'r', rdcc_nbytes=HDF_CACHE_NBYTES, 
+                  rdcc_nslots=HDF_CACHE_NSLOTS, rdcc_w0=0.75)
+    nbytes = _chunk_cache_nbytes(f)
+    if(nbytes>HDF_CACHE_NBYTES):
+        # chunks too big for the default cache, reopen with a larger one
+        f.close()
+        f = h5py.File(fullpath, 'r', rdcc_nbytes=nbytes, 
+                      rdcc_nslots=HDF_CACHE_NSLOTS, rdcc_w0=0.75)
+    return f
+
 def open_hdf5(dat, path=''):
-    fullpath = os.path.join(path, 'dat{0:d}.h5'.format(dat))
-    return h5py.File(fullpath, 'r')
+    """ open dat file read only. handles are cached, so opening the same 
+        file again returns the same h5py.File until close_all is called """
+    fullpath = os.path.abspath(os.path.join(path, 'dat{0:d}.h5'.format(dat)))
+    
+    f = _hdf5_files.pop(fullpath, None)
+    if(not f):
+        # not cached, or closed elsewhere
+        f = _open_hdf5_file(fullpath)
+    _hdf5_files[fullpath] = f # move to the end of the queue
+    
+    if(len(_hdf5_files)>HDF_CACHE_MAXFILES):
+        # forget the least recently used file
+        # it closes once nothing else holds a reference to it
+        del _hdf5_files[next(iter(_hdf5_files))]
+    return f
+
+def close_all():
+    """ close every file opened with open_hdf5 """
+    for f in _hdf5_files.values():
+        if(f):
+            f.close()
+    _hdf5_files.clear()
+
+def read_region(ds, region=None):
+    """ read region of h5py dataset ds into memory
+        region is a slice or tuple of slices with step 1, defaults to the whole dataset 
+        anything else raises ValueError
+        chunked datasets are read one full row of chunks at a time, covering 
+        the chunk aligned bounding box of region, then sliced in memory """
+    
+    if(ds.ndim==0):
+        return ds[()]
+    if(region is None):
+        region = ()
+    elif(not isinstance(region, tuple)):
+        region = (region,)
+    if(len(region)>ds.ndim or 
+       not all(isinstance(r, slice) and r.step in (None, 1) for r in region)):
+        raise ValueError('region must be at most {0:d} slices with step 1, got {1}'.format(ds.ndim, region))
+    region = region + (slice(None),)*(ds.ndim-len(region))
+    region = tuple(slice(*r.indices(n)[:2]) for r, n in zip(region, ds.shape))
+    shape = tuple(max(r.stop-r.start, 0) for r in region)
+    
+    if(ds.chunks is None or 0 in shape):
+        # contiguous storage, one read straight into the output
+        out = np.empty(shape, dtype=ds.dtype)
+        if(0 not in shape):
+            ds.read_direct(out, source_sel=region)
+        return out
+    
+    # expand region to chunk boundaries
+    lo = [(r.start//c)*c for r, c in zip(region, ds.chunks)]
+    hi = [min(-(-r.stop//c)*c, n) for r, c, n in zip(region, ds.chunks, ds.shape)]
+    buf = np.empty([h-l for l, h in zip(lo, hi)], dtype=ds.dtype)
+    
+    c0 = ds.chunks[0]
+    for start in range(lo[0], hi[0], c0):
+        stop = min(start+c0, hi[0])
+        source = (slice(start, stop),) + tuple(slice(l, h) for l, h in zip(lo[1:], hi[1:]))
+        ds.read_direct(buf, source_sel=source, dest_sel=np.s_[start-lo[0]:stop-lo[0]])
+    
+    return buf[tuple(slice(r.start-l, r.stop-l) for r, l in zip(region, lo))]
+
+def load_wave(dat, name, path='', region=None):
+    """ read the dataset name from dat into memory, see read_region """
+    return read_region(open_hdf5(dat, path=path)[name], region)
 
 ################
 ### PLOTTING ###
@@ -88,31 +189,53 @@ def add_subplot_id(ax, id_lttr, loc, fontsize=16):
 
 def dfdx(f, x, axis = None):
     # returns df(x)/dx
-    dx = (x - np.roll(x,1))[1:].mean()
+    # mean step of an evenly spaced x, the sum of steps telescopes to x[-1]-x[0]
+    dx = (x[-1] - x[0])/(len(x) - 1)
     return np.gradient(f,dx, axis = axis)
 
+def _running_mean(a, avgs, axis=-1):
+    # mean of each window of avgs points along axis, in O(n)
+    # from differences of a float64 cumulative sum with a leading zero
+    a = np.moveaxis(np.asarray(a), axis, -1)
+    ret = np.zeros(a.shape[:-1] + (a.shape[-1]+1,))
+    np.cumsum(a, axis=-1, dtype=np.float64, out=ret[...,1:])
+    ret = (ret[...,avgs:] - ret[...,:-avgs])/avgs
+    return np.moveaxis(ret, -1, axis)
+
 def moving_avg(x, y, avgs, axis = None) :
+    
+    if axis is None:
+        y = np.ravel(y)
+        axis = -1
+    return _running_mean(x, avgs), _running_mean(y, avgs, axis=axis)
         
-    xx = np.cumsum(x, dtype=np.float)
-    xx[avgs:] = xx[avgs:] - xx[:-avgs]
-    xx = xx[avgs - 1:] / avgs
-
-    if axis==0:
-        ret = np.cumsum(y, axis=0, dtype=np.float)
-        ret[avgs:] = ret[avgs:] - ret[:-avgs]
-        return xx, ret[avgs - 1:] / avgs
-    elif axis==1:
-        ret = np.cumsum(y, axis=1, dtype=np.float)
-        ret[:,avgs:] = ret[:,avgs:] - ret[:,:-avgs]
-        return xx, ret[:,avgs - 1:] / avgs
+def nearest_index(x, targets):
+    """ index of the value in strictly monotonic, NaN free array x closest to each of targets
+        binary search equivalent of np.argmin(np.abs(x-target)) for such x """
+    
+    x = np.asarray(x)
+    targets = np.asarray(targets)
+    if(len(x)==1):
+        return np.zeros(targets.shape, dtype=np.intp)
+    descending = x[-1]<x[0]
+    if(descending):
+        x = x[::-1]
+    assert np.all(np.diff(x)>0), 'x must be strictly monotonic'
+    
+    idx = np.clip(np.searchsorted(x, targets), 1, len(x)-1)
+    # step back if the point below the insertion index is closer
+    # ties go to the lower index of the original array, as in argmin
+    if(descending):
+        idx -= (targets-x[idx-1]) < (x[idx]-targets)
+        return len(x)-1-idx
     else:
-        ret = np.cumsum(y, dtype=np.float)
-        ret[avgs:] = ret[avgs:] - ret[:-avgs]
-        return xx, ret[avgs - 1:] / avgs
-        
+        idx -= (targets-x[idx-1]) <= (x[idx]-targets)
+        return idx
+
 def get_subset(data, bounds):
     """ select cuts of data based on x,y limits
-        bounds can be None, which defaults to the extents of x,y """
+        bounds can be None, which defaults to the extents of x,y 
+        z may be an h5py dataset, in which case only the cut is read """
     
     if(len(bounds)!=2*len(data[2].shape)):
         raise ValueError('Dimensions of bounds and w.extent must match')
@@ -123,32 +246,36 @@ def get_subset(data, bounds):
     bs = [b if b else extent[i] for i,b in enumerate(bounds)]
 
     if(len(data[2].shape)==2):
-        ix0 = np.nanargmin(np.abs(data[0]-bs[0]))
-        ix1 = np.nanargmin(np.abs(data[0]-bs[1]))
-        iy0 = np.nanargmin(np.abs(data[1]-bs[2]))
-        iy1 = np.nanargmin(np.abs(data[1]-bs[3]))
+        ix0, ix1 = nearest_index(data[0], bs[0:2])
+        iy0, iy1 = nearest_index(data[1], bs[2:4])
         
+        if(isinstance(data[2], h5py.Dataset)):
+            # only read the selected part of the file
+            return data[0][ix0:ix1], data[1][iy0:iy1], read_region(data[2], np.s_[iy0:iy1,ix0:ix1])
         return data[0][ix0:ix1], data[1][iy0:iy1], data[2][iy0:iy1,ix0:ix1]
     else:
         raise NotImplemented('1d waves not implemented. Go fix it.')
         
 def xy_to_meshgrid(x,y):
-    """ returns a meshgrid that makes sense for pcolorgrid
-        given z data that should be centered at (x,y) pairs """
+    """ returns 1d cell edges that make sense for pcolormesh
+        given z data that should be centered at (x,y) pairs 
+        pcolormesh(xx, yy, z) accepts these directly, no meshgrid needed """
     nx = len(x)
     ny = len(y)
 
     dx = (x[-1] - x[0]) / float(nx - 1)
     dy = (y[-1] - y[0]) / float(ny - 1)
 
-    # shift x and y back by half a step
-    x = x-dx/2.0
-    y = y-dy/2.0
+    # shift x and y back by half a step, add the last edge
+    xx = np.empty(nx+1)
+    xx[:-1] = x - dx/2.0
+    xx[-1] = x[-1] + dx/2.0
     
-    xn = x[-1]+dx
-    yn = y[-1]+dy
+    yy = np.empty(ny+1)
+    yy[:-1] = y - dy/2.0
+    yy[-1] = y[-1] + dy/2.0
     
-    return np.meshgrid(np.append(x,xn), np.append(y,yn))
+    return xx, yy
         
 ###################
 ### LINE SHAPES ###
@@ -161,17 +288,119 @@ def line(x, a, b):
     return a*x + b
 
 def parabola(x, a, b, c):
-    return a*x**2 + b*x + c
+    return (a*x + b)*x + c
 
 def i_sense(x, x0, theta, i0, i1, i2):
     """ fit to sensor current """
     arg = (x-x0)/(2*theta)
     return -i0*np.tanh(arg) + i1*(x-x0) + i2
 
+def i_sense_jac(x, x0, theta, i0, i1, i2):
+    """ jacobian of i_sense with respect to (x0, theta, i0, i1, i2)
+        parameters may be arrays that broadcast against x """
+    arg = (x-x0)/(2*theta)
+    sech2 = np.cosh(arg)**-2
+    return np.stack(np.broadcast_arrays(i0*sech2/(2*theta) - i1, 
+                                        i0*sech2*arg/theta, 
+                                        -np.tanh(arg), 
+                                        x-x0, 
+                                        np.ones_like(arg)), axis=-1)
+
 def di_sense_simple(x, x0, theta, di0, di2, epsilon):
     """ fit charge sensor lock in signal """
     arg = (x-x0)/(2*theta)
-    return -1.0*di0*(arg+0.5*epsilon)*(np.cosh(arg)**-2) + di2
+    c = np.cosh(arg)
+    return -1.0*di0*(arg+0.5*epsilon)/(c*c) + di2
+
+def di_sense_simple_jac(x, x0, theta, di0, di2, epsilon):
+    """ jacobian of di_sense_simple with respect to (x0, theta, di0, di2, epsilon)
+        parameters may be arrays that broadcast against x """
+    arg = (x-x0)/(2*theta)
+    sech2 = np.cosh(arg)**-2
+    dfdarg = -1.0*di0*sech2*(1.0 - 2.0*(arg+0.5*epsilon)*np.tanh(arg))
+    return np.stack(np.broadcast_arrays(-dfdarg/(2*theta), 
+                                        -dfdarg*arg/theta, 
+                                        -1.0*(arg+0.5*epsilon)*sech2, 
+                                        np.ones_like(arg), 
+                                        -0.5*di0*sech2), axis=-1)
+
+# compiled versions of the line shapes above, used as curve_fit targets
+# each fills a preallocated output in one pass over a 1d x array
+
+def _i_sense_kernel(x, x0, theta, i0, i1, i2, out):
+    for j in range(x.shape[0]):
+        arg = (x[j]-x0)/(2*theta)
+        out[j] = -i0*np.tanh(arg) + i1*(x[j]-x0) + i2
+    return out
+
+def _i_sense_jac_kernel(x, x0, theta, i0, i1, i2, jac):
+    for j in range(x.shape[0]):
+        arg = (x[j]-x0)/(2*theta)
+        # tanh and sech**2 from a single exp
+        # exp(-2|arg|) is in (0,1], so nothing overflows for large |arg|
+        e = np.exp(-2.0*abs(arg))
+        d = 1.0/(1.0+e)
+        t = (1.0-e)*d if arg>=0 else (e-1.0)*d
+        s2 = 4.0*e*d*d
+        jac[j,0] = i0*s2/(2*theta) - i1
+        jac[j,1] = i0*s2*arg/theta
+        jac[j,2] = -t
+        jac[j,3] = x[j]-x0
+        jac[j,4] = 1.0
+    return jac
+
+def _di_sense_simple_kernel(x, x0, theta, di0, di2, epsilon, out):
+    for j in range(x.shape[0]):
+        arg = (x[j]-x0)/(2*theta)
+        s = 1.0/np.cosh(arg)
+        out[j] = -1.0*di0*(arg+0.5*epsilon)*s*s + di2
+    return out
+
+def _di_sense_simple_jac_kernel(x, x0, theta, di0, di2, epsilon, jac):
+    for j in range(x.shape[0]):
+        arg = (x[j]-x0)/(2*theta)
+        e = np.exp(-2.0*abs(arg))
+        d = 1.0/(1.0+e)
+        t = (1.0-e)*d if arg>=0 else (e-1.0)*d
+        s2 = 4.0*e*d*d
+        shift = arg+0.5*epsilon
+        dfdarg = -1.0*di0*s2*(1.0 - 2.0*shift*t)
+        jac[j,0] = -dfdarg/(2*theta)
+        jac[j,1] = -dfdarg*arg/theta
+        jac[j,2] = -1.0*shift*s2
+        jac[j,3] = 1.0
+        jac[j,4] = -0.5*di0*s2
+    return jac
+
+if(njit):
+    _i_sense_kernel = njit(cache=True, fastmath=True)(_i_sense_kernel)
+    _i_sense_jac_kernel = njit(cache=True, fastmath=True)(_i_sense_jac_kernel)
+    _di_sense_simple_kernel = njit(cache=True, fastmath=True)(_di_sense_simple_kernel)
+    _di_sense_simple_jac_kernel = njit(cache=True, fastmath=True)(_di_sense_simple_jac_kernel)
+
+def _i_sense_fit(x, x0, theta, i0, i1, i2):
+    if(not njit):
+        return i_sense(x, x0, theta, i0, i1, i2)
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    return _i_sense_kernel(x, x0, theta, i0, i1, i2, np.empty_like(x))
+
+def _i_sense_jac_fit(x, x0, theta, i0, i1, i2):
+    if(not njit):
+        return i_sense_jac(x, x0, theta, i0, i1, i2)
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    return _i_sense_jac_kernel(x, x0, theta, i0, i1, i2, np.empty((len(x), 5)))
+
+def _di_sense_simple_fit(x, x0, theta, di0, di2, epsilon):
+    if(not njit):
+        return di_sense_simple(x, x0, theta, di0, di2, epsilon)
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    return _di_sense_simple_kernel(x, x0, theta, di0, di2, epsilon, np.empty_like(x))
+
+def _di_sense_simple_jac_fit(x, x0, theta, di0, di2, epsilon):
+    if(not njit):
+        return di_sense_simple_jac(x, x0, theta, di0, di2, epsilon)
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    return _di_sense_simple_jac_kernel(x, x0, theta, di0, di2, epsilon, np.empty((len(x), 5)))
 
 def p_up(field, temp, g, de):
     return 1/(1+np.exp(-(g*MU_B*field-de)/(K_B*temp)))
@@ -187,12 +416,26 @@ def gibbs_entropy(field, a, b, temp, g, de):
 ### LINES ###
 #############
 
+def _dist_2_line_kernel(x, y, x0, y0, delta2):
+    # stops at the first point within delta
+    for j in range(x.shape[0]):
+        if((x[j]-x0)**2 + (y[j]-y0)**2 < delta2):
+            return True
+    return False
+
+if(njit):
+    _dist_2_line_kernel = njit(cache=True)(_dist_2_line_kernel)
+
 def dist_2_line(x, y, point, delta):
     # line defined by x, y
     # test if point = [x0,y0] is within delta of line
-    test_line = np.stack((x, y)).transpose()
-    dist = np.linalg.norm(test_line-point, axis=1)
-    return np.any(dist<delta)
+    # compares squared distances, no sqrt needed
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if(njit):
+        return _dist_2_line_kernel(x, y, float(point[0]), float(point[1]), float(delta)**2)
+    dist2 = (x-point[0])**2 + (y-point[1])**2
+    return np.any(dist2<delta*delta)
 
 def x_intersection(fit0, fit1):
     # fit = (m,b)
@@ -208,34 +451,122 @@ def y_intersection(fit0, fit1):
 ### FIT MULTIPLE ###
 ####################
 
-def i_sense_fit_simultaneous(x, z, centers, widths, x0bounds, constrain = None, span = None):
-    """ fit multiple sensor current data simultaneously
-        with the option to force one or more parameters to the same value across all 
-        datasets """
-        
-    def i_sense_dataset(params, i, xx):
-        # x0, theta, i0, i1, i2
-        
-        x0 = params['x0_{0:d}'.format(i)]
-        theta = params['theta_{0:d}'.format(i)]
-        i0 = params['i0_{0:d}'.format(i)]
-        i1 = params['i1_{0:d}'.format(i)]
-        i2 = params['i2_{0:d}'.format(i)]
+def window_mask(idx0, idx1, m):
+    """ (n,m) boolean mask, True in columns idx0[i]:idx1[i] of each row i """
+    cols = np.arange(m)
+    return (cols>=idx0[:,np.newaxis]) & (cols<(idx1 % m)[:,np.newaxis]) # idx1=-1 means m-1
+
+def fit_global(func, jac, x, z, mask, p0, bounds, shared=(), fixed=()):
+    """ least squares fit of func to the points of every row of z where mask is True
+        all rows are fit at once, so parameters can be tied between rows
         
-        return i_sense(xx, x0, theta, i0, i1, i2)
+        p0 has shape (n, k), bounds is (lower, upper) for a single row. 
+        columns listed in shared take the value from the first row in every row, 
+        columns listed in fixed stay at p0. returns fit parameters, shape (n, k) """
     
-    def i_sense_objective(params, xx, zz, idx0, idx1):
-        """ calculate total residual for fits to several data sets held
-            in a 2-D array"""
-        
-        n,m = zz.shape
-        resid = []
-        # make residual per data set
-        for i in range(n):
-            resid.append(zz[i,idx0[i]:idx1[i]] - i_sense_dataset(params, i, xx[i,idx0[i]:idx1[i]]))
-        # now flatten this to a 1D array, as minimize() needs
-        return np.concatenate(resid)
+    n, k = p0.shape
+    lower = np.broadcast_to(np.asarray(bounds[0], dtype=float), (n, k))
+    upper = np.broadcast_to(np.asarray(bounds[1], dtype=float), (n, k))
+    p0 = np.clip(p0, lower, upper)
+    
+    # index of each parameter in the reduced vector q, -1 if fixed
+    index = -1*np.ones((n, k), dtype=int)
+    free = np.ones((n, k), dtype=bool)
+    free[1:,list(shared)] = False
+    free[:,list(fixed)] = False
+    index[free] = np.arange(free.sum())
+    index[1:,list(shared)] = index[0,list(shared)]
+    
+    # all parameters are p = E @ q + pfixed
+    vary = index>=0
+    E = csr_matrix((np.ones(vary.sum()), (np.flatnonzero(vary), index[vary])), 
+                   shape=(n*k, free.sum()))
+    pfixed = np.where(vary, 0.0, p0).ravel()
+    
+    # flat indices of the fitted points, row by row
+    pts = np.flatnonzero(mask)
+    npts = len(pts)
+    zfit = z[mask]
+    
+    # each point only depends on the k parameters of its own row
+    # the sparsity pattern is built once, each call only refills jfull.data
+    rows = pts//mask.shape[1]
+    jfull = csr_matrix((np.empty(npts*k), (k*rows[:,np.newaxis] + np.arange(k)).ravel(), 
+                        np.arange(0, npts*k+1, k)), shape=(npts, n*k))
     
+    def unpack(q):
+        # k parameter columns, each with shape (n,1)
+        return (E.dot(q) + pfixed).reshape(n, k).transpose()[:,:,np.newaxis]
+    
+    def resid(q):
+        # the precomputed flat index pts replaces the boolean mask and zfit is 
+        # subtracted in place; least_squares keeps earlier residuals around, 
+        # so each call must still return a fresh array
+        r = func(x, *unpack(q)).take(pts)
+        r -= zfit
+        return r
+    
+    def resid_jac(q):
+        jfull.data[:] = jac(x, *unpack(q)).reshape(-1, k).take(pts, axis=0).ravel()
+        return jfull.dot(E)
+    
+    # parameters differ by orders of magnitude, scale steps by the jacobian 
+    # the default xtol stops ill-conditioned fits (theta tied across warm scans) early
+    result = least_squares(resid, p0[free], jac=resid_jac, 
+                           bounds=(lower[free], upper[free]), method='trf', 
+                           x_scale='jac', xtol=1e-10)
+    return (E.dot(result.x) + pfixed).reshape(n, k)
+
+def _map_datasets(func, args, n_jobs=None):
+    """ returns [func(*a) for a in args], spread over n_jobs processes 
+        if n_jobs is given and joblib is installed """
+    if(n_jobs is None or Parallel is None):
+        return [func(*a) for a in args]
+    return Parallel(n_jobs=n_jobs, backend='loky')(delayed(func)(*a) for a in args)
+
+def _i_sense_fit_dataset(xx, zz, p0, bounds):
+    """ fit a single sensor current trace """
+    popt, _ = curve_fit(_i_sense_fit, xx, zz, p0=p0, bounds=bounds, jac=_i_sense_jac_fit)
+    return popt
+
+def _di_bootstrap_eps(mboot, xx, zz, fit_params, jlow, jhigh, pp0, bbounds, bootstat):
+    """ bootstrap estimate of errors on epsilon for single curve fit 
+        Following this: http://www.phas.ubc.ca/~oser/p509/Lec_20.pdf """
+    
+    # create zfit and resid, both of which have shape=z.shape
+    zfit = di_sense_simple(xx, *fit_params)
+    resid = zz - zfit
+    
+    boot_results = np.zeros((mboot,len(fit_params)))
+    for k in range(mboot):
+        ztest = zfit + np.random.choice(resid.flatten(), size=zfit.shape)
+        out, _ = curve_fit(_di_sense_simple_fit, xx[jlow:jhigh], 
+                            ztest[jlow:jhigh], p0=pp0, bounds=bbounds, 
+                            jac=_di_sense_simple_jac_fit)
+        boot_results[k] = out
+    
+    if bootstat=='bounds':
+        return np.percentile(boot_results[:,-1], [2.5, 97.5])
+    elif bootstat=='std':
+        return np.array([boot_results[:,-1].std(), boot_results[:,-1].std()])
+
+def _di_fit_dataset(xx, zz, jlow, jhigh, p0, bounds, nboot, bootstat):
+    """ fit a single lock in trace, returns the fit and 
+        bootstrap errors on epsilon (None if nboot is not set) """
+    popt, _ = curve_fit(_di_sense_simple_fit, xx[jlow:jhigh], zz[jlow:jhigh], 
+                        p0=p0, bounds=bounds, jac=_di_sense_simple_jac_fit)
+    if nboot:
+        return popt, _di_bootstrap_eps(nboot, xx, zz, popt, jlow, jhigh, p0, bounds, bootstat)
+    return popt, None
+
+def i_sense_fit_simultaneous(x, z, centers, widths, x0bounds, constrain = None, span = None, 
+                             n_jobs = None):
+    """ fit multiple sensor current data simultaneously
+        with the option to force one or more parameters to the same value across all 
+        datasets 
+        without constraints the data sets are fit independently, 
+        over n_jobs processes if n_jobs is given (requires joblib) """
+        
     # get the dimensions of z
     if(z.ndim==1):
         m = len(z)
@@ -250,104 +581,65 @@ def i_sense_fit_simultaneous(x, z, centers, widths, x0bounds, constrain = None,
     # should have a number of rows = 1 or number of rows = len(z)
     
     if(x.ndim==1 or x.shape[0]==1):
-        x = np.tile(x, (n,1))
+        # read only view, every row is the same 1d array
+        x = np.broadcast_to(x.reshape(1,-1), (n, x.shape[-1]))
+        shared_x = True
     elif(x.shape[0]==n):
-        pass
+        shared_x = False
     else:
         raise ValueError('the shape of xarray is wrong')
         
     if(span):
-        icenters = np.nanargmin(np.abs(x.transpose()-centers), axis=0)
-        ilow = np.nanargmin(np.abs(x.transpose()-(centers-span)), axis=0)
-        ihigh = np.nanargmin(np.abs(x.transpose()-(centers+span)), axis=0)
+        if(shared_x):
+            ilow = nearest_index(x[0], centers-span)
+            ihigh = nearest_index(x[0], centers+span)
+        else:
+            # one search per row for both edges of its window
+            ilow, ihigh = np.array([nearest_index(x[i], [centers[i]-span, centers[i]+span]) 
+                                        for i in range(n)]).transpose()
     else:
-        ilow = np.zeros(n, dtype=np.int)
-        ihigh = -1*np.ones(n, dtype=np.int)
+        ilow = np.zeros(n, dtype=int)
+        ihigh = -1*np.ones(n, dtype=int)
     
     columns = ['x0', 'theta', 'i0', 'i1', 'i2']
-    df = pd.DataFrame(columns=columns)
+    popt = np.empty((n, len(columns)))
     
     # add constraints specified in the 'constrain' list
     if(constrain):
         
-        # create parameters, one per data set
-        fit_params = Parameters()
-
-        for i in range(n):
-            fit_params.add('x0_{0:d}'.format(i), value=centers[i], min=x0bounds[0], max=x0bounds[1])
-            fit_params.add('theta_{0:d}'.format(i), value=widths[i], min=0.05, max=10.0)
-            fit_params.add('i0_{0:d}'.format(i), 
-                            value=abs(z[i,ilow[i]:ihigh[i]].max()-z[i,ilow[i]:ihigh[i]].min()),
-                            min=0.001, max=10.0)
-            fit_params.add('i1_{0:d}'.format(i), value=0.1, min=0.0, max=10.0)
-            fit_params.add('i2_{0:d}'.format(i), value=z[i,ilow[i]:ihigh[i]].mean(), min=0.0, max=20.0)
-
-        for p in constrain:
-            for i in range(1,n):
-                fit_params['{0}_{1:d}'.format(p,i)].expr = '{0}_{1:d}'.format(p,0)
-
+        # initial parameters, one row per data set
+        p0 = np.array([[centers[i], widths[i], 
+                        abs(z[i,ilow[i]:ihigh[i]].max()-z[i,ilow[i]:ihigh[i]].min()),
+                        0.1, z[i,ilow[i]:ihigh[i]].mean()] for i in range(n)])
+        bounds = [(x0bounds[0], 0.05, 0.001, 0.0, 0.0), (x0bounds[1], 10.0, 10.0, 10.0, 20.0)]
+        
         # run the global fit to all the data sets
-        m = minimize(i_sense_objective, fit_params, args=(x, z, ilow, ihigh))
-    
-        valdict = m.params.valuesdict()
-        for i in range(n):
-            df.loc[i] = [valdict['{0}_{1:d}'.format(c, i)] for c in columns]
+        # fit windows as a mask, cropped to the columns they cover
+        mask = window_mask(ilow, ihigh, m)
+        lo, hi = ilow.min(), (ihigh % m).max()
+        popt[:] = fit_global(i_sense, i_sense_jac, x[:,lo:hi], z[:,lo:hi], mask[:,lo:hi], 
+                             p0, bounds, shared=[columns.index(p) for p in constrain])
     else:
         # no parameters need to be fixed between data sets
         # fit them all separately (much faster)
+        bounds = [(x0bounds[0], 0.05, 0.001, 0.0, 0.0), (x0bounds[1], 10.0, 10.0, 10.0, 20.0)]
+        args = []
         for i in range(n):
             p0 = [centers[i], widths[i], abs(z[i,ilow[i]:ihigh[i]].max()-z[i,ilow[i]:ihigh[i]].min()),
                       0.1, z[i,ilow[i]:ihigh[i]].mean()]
-            bounds = [(x0bounds[0], 0.05, 0.001, 0.0, 0.0), (x0bounds[1], 10.0, 10.0, 10.0, 20.0)]
-            df.loc[i], _ = curve_fit(i_sense, x[i,ilow[i]:ihigh[i]], z[i,ilow[i]:ihigh[i]], p0=p0, bounds=bounds)
+            args.append((x[i,ilow[i]:ihigh[i]], z[i,ilow[i]:ihigh[i]], p0, bounds))
+        popt[:] = _map_datasets(_i_sense_fit_dataset, args, n_jobs)
                           
-    return df
+    return pd.DataFrame(popt, columns=columns)
 
 def di_fit_simultaneous(x, z, centers, widths, x0bounds, 
                         constrain = None, fix = None, span = None, 
-                        nboot=None, bootstat='bounds'):
-    
-    def di_bootstrap_eps(mboot, xx, zz, fit_params, jlow, jhigh, pp0, bbounds):
-        """ bootstrap estimate of errors on epsilon for single curve fit 
-            Following this: http://www.phas.ubc.ca/~oser/p509/Lec_20.pdf """
-        
-        # create zfit and resid, both of which have shape=z.shape
-        zfit = di_sense_simple(xx, *fit_params)
-        resid = zz - zfit
-        
-        boot_results = np.zeros((mboot,len(fit_params)))
-        for k in range(mboot):
-            ztest = zfit + np.random.choice(resid.flatten(), size=zfit.shape)
-            out, _ = curve_fit(di_sense_simple, xx[jlow:jhigh], 
-                                ztest[jlow:jhigh], p0=pp0, bounds=bbounds)
-            boot_results[k] = out
-        
-        if bootstat=='bounds':
-            return np.percentile(boot_results[:,-1], [2.5, 97.5])
-        elif bootstat=='std':
-            return np.array([boot_results[:,-1].std(), boot_results[:,-1].std()])
-    
-    def di_dataset(params, i, xx):
-        
-        x0 = params['x0_{0:d}'.format(i)]
-        theta = params['theta_{0:d}'.format(i)]
-        di0 = params['di0_{0:d}'.format(i)]
-        di2 = params['di2_{0:d}'.format(i)]
-        epsilon = params['epsilon_{0:d}'.format(i)]
-        
-        return di_sense_simple(xx, x0, theta, di0, di2, epsilon)
-    
-    def di_objective(params, xx, zz, idx0, idx1):
-        """ calculate total residual for fits to several data sets held
-            in a 2-D array """
-        
-        n,m = zz.shape
-        resid = []
-        # make residual per data set
-        for i in range(n):
-            resid.append(zz[i,idx0[i]:idx1[i]] - di_dataset(params, i, x[i,idx0[i]:idx1[i]]))
-        # now flatten this to a 1D array, as minimize() needs
-        return np.concatenate(resid)
+                        nboot=None, bootstat='bounds', n_jobs = None):
+    """ fit multiple lock in data simultaneously
+        with the option to force one or more parameters to the same value across all 
+        datasets, or fix them at their initial values 
+        without constraints the data sets are fit independently, 
+        over n_jobs processes if n_jobs is given (requires joblib) """
     
     # get the dimensions of z
     if(z.ndim==1):
@@ -363,73 +655,61 @@ def di_fit_simultaneous(x, z, centers, widths, x0bounds,
     # should have a number of rows = 1 or number of rows = len(z)
     
     if(x.ndim==1 or x.shape[0]==1):
-        x = np.tile(x, (n,1))
+        # read only view, every row is the same 1d array
+        x = np.broadcast_to(x.reshape(1,-1), (n, x.shape[-1]))
+        shared_x = True
     elif(x.shape[0]==n):
-        pass
+        shared_x = False
     else:
         raise ValueError('the shape of xarray is wrong')
         
     if(span):
-        icenters = np.nanargmin(np.abs(x.transpose()-centers), axis=0)
-        ilow = np.nanargmin(np.abs(x.transpose()-(centers-span)), axis=0)
-        ihigh = np.nanargmin(np.abs(x.transpose()-(centers+span)), axis=0)
+        if(shared_x):
+            ilow = nearest_index(x[0], centers-span)
+            ihigh = nearest_index(x[0], centers+span)
+        else:
+            # one search per row for both edges of its window
+            ilow, ihigh = np.array([nearest_index(x[i], [centers[i]-span, centers[i]+span]) 
+                                        for i in range(n)]).transpose()
     else:
-        ilow = np.zeros(n, dtype=np.int)
-        ihigh = -1*np.ones(n, dtype=np.int)
+        ilow = np.zeros(n, dtype=int)
+        ihigh = -1*np.ones(n, dtype=int)
     
     columns = ['x0', 'theta', 'di0', 'di2', 'epsilon']
-    df = pd.DataFrame(columns=columns)
+    popt = np.empty((n, len(columns)))
     
     # add constraints specified in the 'constrain' list
     if(constrain or fix):
         
-        # create parameters, one per data set
-        fit_params = Parameters()
-
-        for i in range(n):
-            fit_params.add('x0_{0:d}'.format(i), value=centers[i], min=x0bounds[0], max=x0bounds[1])
-            fit_params.add('theta_{0:d}'.format(i), value=widths[i], min=0.05, max=10.0)
-            fit_params.add('di0_{0:d}'.format(i), 
-                            value=0.5*max(abs(z[i,ilow[i]:ihigh[i]].min()),
-                                          abs(z[i,ilow[i]:ihigh[i]].max())), 
-                           min=0.0, max=0.5)
-            fit_params.add('di2_{0:d}'.format(i), value=(z[i,ilow[i]]+z[i,ihigh[i]])/2.0, 
-                           min=-0.01, max=0.01)
-            fit_params.add('epsilon_{0:d}'.format(i), value=0.0, min=-2.0, max=2.0)
-
-        if(constrain):
-            for p in constrain:
-                for i in range(1,n):
-                    fit_params['{0}_{1:d}'.format(p,i)].expr = '{0}_{1:d}'.format(p,0)
-                    
-        if(fix):
-            for p in fix:
-                for i in range(n):
-                    fit_params['{0}_{1:d}'.format(p,i)].vary = False
-                    
+        # initial parameters, one row per data set
+        p0 = np.array([[centers[i], widths[i], 
+                        0.5*max(abs(z[i,ilow[i]:ihigh[i]].min()), abs(z[i,ilow[i]:ihigh[i]].max())),
+                        (z[i,ilow[i]]+z[i,ihigh[i]])/2.0, 0.0] for i in range(n)])
+        bounds = [(x0bounds[0], 0.05, 0.0, -0.01, -2.0), (x0bounds[1], 10.0, 0.5, 0.01, 2.0)]
+        
         # run the global fit to all the data sets
-        m = minimize(di_objective, fit_params, args=(x, z, ilow, ihigh))
-    
-        valdict = m.params.valuesdict()
-        for i in range(n):
-            df.loc[i] = [valdict['{0}_{1:d}'.format(c, i)] for c in columns]
+        # fit windows as a mask, cropped to the columns they cover
+        mask = window_mask(ilow, ihigh, m)
+        lo, hi = ilow.min(), (ihigh % m).max()
+        popt[:] = fit_global(di_sense_simple, di_sense_simple_jac, 
+                             x[:,lo:hi], z[:,lo:hi], mask[:,lo:hi], p0, bounds, 
+                             shared=[columns.index(p) for p in (constrain or [])], 
+                             fixed=[columns.index(p) for p in (fix or [])])
     else:
         # no parameters need to be fixed between data sets
         # fit them all separately (much faster)
-        if nboot:
-            eps_err = np.zeros((n,2))
+        bounds = [(x0bounds[0], 0.05, 0.0, -0.05, -2.0), (x0bounds[1], 10.0, 0.5, 0.05, 2.0)]
+        args = []
         for i in range(n):
             p0 = [centers[i], widths[i], 
                   max(abs(z[i,ilow[i]:ihigh[i]].min()), abs(z[i,ilow[i]:ihigh[i]].max())),
                   (z[i,ilow[i]]+z[i,ihigh[i]])/2.0, 0.0]
-            bounds = [(x0bounds[0], 0.05, 0.0, -0.05, -2.0), (x0bounds[1], 10.0, 0.5, 0.05, 2.0)]
-            df.loc[i], _ = curve_fit(di_sense_simple, x[i,ilow[i]:ihigh[i]], 
-                                             z[i,ilow[i]:ihigh[i]], p0=p0, bounds=bounds)
-            
-            if nboot:
-                eps_err[i] = di_bootstrap_eps(nboot, x[i], z[i], df.loc[i],
-                                     ilow[i], ihigh[i], p0, bounds)
+            args.append((x[i], z[i], ilow[i], ihigh[i], p0, bounds, nboot, bootstat))
+        results = _map_datasets(_di_fit_dataset, args, n_jobs)
+        popt[:] = [r[0] for r in results]
+        
         if nboot:
-            return df, eps_err
+            eps_err = np.array([r[1] for r in results])
+            return pd.DataFrame(popt, columns=columns), eps_err
             
-    return df
\ No newline at end of file
+    return pd.DataFrame(popt, columns=columns)
\ No newline at end of file